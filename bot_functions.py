@@ -1,15 +1,24 @@
 import os
+import hmac
 import logging
-import time
-import csv
-from datetime import datetime
+import secrets
+import threading
+import tempfile
 from dotenv import load_dotenv
 import telebot
-import json
+from telebot import apihelper
+import requests
+from requests.adapters import HTTPAdapter
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse
+from cachetools import TTLCache
 
 from db_connect import (
-    init_db, get_user_tasks, save_task_to_db, mark_done_in_db,
-    delete_task_from_db, clear_all_tasks_db, done_all_tasks_db
+    init_db, get_user_tasks, mark_done_in_db,
+    delete_task_from_db, clear_all_tasks_db, done_all_tasks_db,
+    export_tasks_csv, get_list_text, cache_list_text,
+    enqueue_task, predict_task_number
 )
 
 # Настройка логирования
@@ -31,65 +40,113 @@ API_TOKEN = os.getenv('TELEGRAM_API_TOKEN')
 if not API_TOKEN:
     raise ValueError("Токен Telegram не найден в .env!")
 
+# Вебхук (если задан WEBHOOK_URL); без него бот работает через long polling.
+# TLS для вебхука завершается на обратном прокси перед ботом
+WEBHOOK_URL = os.getenv('WEBHOOK_URL')
+WEBHOOK_PORT = int(os.getenv('WEBHOOK_PORT', '8443'))
+WEBHOOK_SECRET = os.getenv('WEBHOOK_SECRET') or secrets.token_urlsafe(32)
+WEBHOOK_PATH = urlparse(WEBHOOK_URL or '').path or '/'
+
+# Число потоков, в которых параллельно выполняются обработчики сообщений
+BOT_THREADS = int(os.getenv('BOT_THREADS', '8'))
+
+
+# Одна HTTP-сессия на все запросы к Telegram API: keep-alive и пул соединений
+# вместо нового TLS-рукопожатия на каждый ответ
+http_session = requests.Session()
+http_session.mount('https://', HTTPAdapter(pool_connections=20, pool_maxsize=50, max_retries=3))
+apihelper.session = http_session
 
 # Инициализация бота
-bot = telebot.TeleBot(API_TOKEN)
+bot = telebot.TeleBot(API_TOKEN, num_threads=BOT_THREADS)
+
+# Состояние диалога (user_id → stage, data); брошенные диалоги забываются
+# через 10 минут. TTLCache не потокобезопасен, поэтому доступ — под блокировкой
+user_state = TTLCache(maxsize=100_000, ttl=600)
+user_state_lock = threading.Lock()
+
+# Поправки к ответам, отправленным до записи задачи в БД, уходят из
+# отдельных потоков, чтобы не задерживать фоновую запись задач
+followup_executor = ThreadPoolExecutor(max_workers=2, thread_name_prefix="followup")
+
+# Неизменяемые ответы бота
+START_MESSAGE = (
+    "Привет! Я бот для управления задачами.\n"
+    "Чтобы добавить задачу:\n"
+    "— напишите любой текст, или\n"
+    "— используйте команду /add\n"
+    "/list — показать задачи\n"
+    "/done <номер> — отметить как выполненную\n"
+    "/delete <номер> — удалить задачу\n"
+    "/export — экспортировать задачи в CSV\n"
+    "/clear_all — удалить все задачи\n"
+    "/done_all — отметить все задачи как выполненные"
+)
+DONE_USAGE_MESSAGE = "Используйте: /done <номер_задачи>"
+DELETE_USAGE_MESSAGE = "Используйте: /delete <номер_задачи>"
+TASK_ID_NOT_NUMBER_MESSAGE = "Номер задачи должен быть числом!"
+ERROR_MESSAGE = "Произошла ошибка. Попробуйте снова."
+TASK_ADDED_MESSAGE = "[✳️] Задача №{task_id} добавлена!\nЗадача: {text}"
 
-# Словарь для хранения состояния диалога (user_id → stage, data)
-user_state = {}
+# Отметка статуса по индексу bool(done): 0 или 1 (NULL в БД — невыполненная)
+STATUS_MARKS = ("[✳️]", "[✅]")
 
 def format_tasks(tasks):
     """Форматировать список задач для вывода в Telegram"""
     if not tasks:
         return "У вас нет задач."
-    lines = []
-    for task in tasks:
-        status = "[✅]" if task['done'] else "[✳️]"
-        try:
-            created_dt = datetime.fromisoformat(task['created_at'])
-            created_str = created_dt.strftime('%Y-%m-%d %H:%M')
-        except (ValueError, TypeError):
-            created_str = str(task['created_at'])[:16]
-        lines.append(f"{status} {task['task_id_in_list']}. {task['text']} ({created_str})")
-    return "\n".join(lines)
+    # Дата уже отформатирована при загрузке из БД (created_str)
+    return "\n".join(
+        f"{STATUS_MARKS[bool(t['done'])]} {t['task_id_in_list']}. {t['text']} ({t['created_str']})"
+        for t in tasks
+    )
 
 
 @bot.message_handler(commands=['start'])
 def start(message):
-    logger.info(f"Получен /start от user_id={message.from_user.id}")
-    bot.reply_to(message, "Привет! Я бот для управления задачами.\n"
-                     "Чтобы добавить задачу:\n"
-                     "— напишите любой текст, или\n"
-                     "— используйте команду /add\n"
-                         "/list — показать задачи\n"
-                         "/done <номер> — отметить как выполненную\n"
-                         "/delete <номер> — удалить задачу\n"
-                         "/export — экспортировать задачи в CSV\n"
-                         "/clear_all — удалить все задачи\n"
-                         "/done_all — отметить все задачи как выполненные")
+    logger.info("Получен /start от user_id=%s", message.from_user.id)
+    bot.reply_to(message, START_MESSAGE)
 
 
 @bot.message_handler(commands=['list'])
 def list_tasks(message):
+    user_id = message.from_user.id
     try:
-        tasks = get_user_tasks(message.from_user.id)
-        response = format_tasks(tasks)
+        response, version = get_list_text(user_id)
+        if response is None:
+            tasks = get_user_tasks(user_id)
+            if tasks is None:
+                bot.reply_to(message, "Произошла ошибка при загрузке задач. Попробуйте позже.")
+                return
+            response = format_tasks(tasks)
+            # Если задачи изменились после чтения version, текст не сохранится.
+            # Остаётся короткое окно, пока другой процесс не получил NOTIFY и
+            # отдаёт задачи из своей памяти: такой текст может устареть
+            # (не дольше LIST_TEXT_TTL)
+            cache_list_text(user_id, response, version)
         bot.reply_to(message, response)
     except Exception as e:
-        logger.error(f"Ошибка при получении задач для user_id={message.from_user.id}: {e}")
+        logger.error("Ошибка при получении задач для user_id=%s: %s", message.from_user.id, e)
         bot.reply_to(message, "Произошла ошибка при загрузке задач. Попробуйте позже.")
 
 
+def parse_task_id(message, usage_message):
+    """Получить номер задачи из аргумента команды; при ошибке ответить и вернуть None"""
+    parts = message.text.split(maxsplit=1)
+    arg = parts[1].strip() if len(parts) > 1 else ''
+    if not arg:
+        bot.reply_to(message, usage_message)
+        return None
+    if not arg.isdecimal():
+        bot.reply_to(message, TASK_ID_NOT_NUMBER_MESSAGE)
+        return None
+    return int(arg)
+
+
 @bot.message_handler(commands=['done'])
 def done_task(message):
-    args = message.text.split()
-    if len(args) != 2:
-        bot.reply_to(message, "Используйте: /done <номер_задачи>")
-        return
-    try:
-        task_id = int(args[1])
-    except ValueError:
-        bot.reply_to(message, "Номер задачи должен быть числом!")
+    task_id = parse_task_id(message, DONE_USAGE_MESSAGE)
+    if task_id is None:
         return
     try:
         if mark_done_in_db(message.from_user.id, task_id):
@@ -97,20 +154,14 @@ def done_task(message):
         else:
             bot.reply_to(message, "Задача не найдена или уже выполнена.")
     except Exception as e:
-        logger.error(f"Ошибка при отметке задачи user_id={message.from_user.id}, task_id={task_id}: {e}")
-        bot.reply_to(message, "Произошла ошибка. Попробуйте снова.")
+        logger.error("Ошибка при отметке задачи user_id=%s, task_id=%s: %s", message.from_user.id, task_id, e)
+        bot.reply_to(message, ERROR_MESSAGE)
 
 
 @bot.message_handler(commands=['delete'])
 def delete_task(message):
-    args = message.text.split()
-    if len(args) != 2:
-        bot.reply_to(message, "Используйте: /delete <номер_задачи>")
-        return
-    try:
-        task_id = int(args[1])
-    except ValueError:
-        bot.reply_to(message, "Номер задачи должен быть числом!")
+    task_id = parse_task_id(message, DELETE_USAGE_MESSAGE)
+    if task_id is None:
         return
     try:
         if delete_task_from_db(message.from_user.id, task_id):
@@ -118,8 +169,8 @@ def delete_task(message):
         else:
             bot.reply_to(message, "Задача не найдена.")
     except Exception as e:
-        logger.error(f"Ошибка при удалении задачи user_id={message.from_user.id}, task_id={task_id}: {e}")
-        bot.reply_to(message, "Произошла ошибка. Попробуйте снова.")
+        logger.error("Ошибка при удалении задачи user_id=%s, task_id=%s: %s", message.from_user.id, task_id, e)
+        bot.reply_to(message, ERROR_MESSAGE)
 
 @bot.message_handler(commands=['clear_all'])
 def clear_all_tasks(message):
@@ -134,8 +185,8 @@ def clear_all_tasks(message):
         else:
             bot.reply_to(message, "Не удалось удалить задачи. Попробуйте позже.")
     except Exception as e:
-        logger.error(f"Ошибка при очистке всех задач user_id={user_id}: {e}")
-        bot.reply_to(message, "Произошла ошибка. Попробуйте снова.")
+        logger.error("Ошибка при очистке всех задач user_id=%s: %s", user_id, e)
+        bot.reply_to(message, ERROR_MESSAGE)
 
 
 @bot.message_handler(commands=['done_all'])
@@ -151,96 +202,159 @@ def done_all_tasks(message):
         else:
             bot.reply_to(message, "Не удалось отметить задачи. Попробуйте позже.")
     except Exception as e:
-        logger.error(f"Ошибка при отметке всех задач как выполненных user_id={user_id}: {e}")
-        bot.reply_to(message, "Произошла ошибка. Попробуйте снова.")
+        logger.error("Ошибка при отметке всех задач как выполненных user_id=%s: %s", user_id, e)
+        bot.reply_to(message, ERROR_MESSAGE)
+
+
+EXPORT_BUFFER_SIZE = 1 << 16  # 64 КиБ: COPY пишет в файл крупными блоками
 
 
 @bot.message_handler(commands=['export'])
 def export_tasks(message):
     try:
-        tasks = get_user_tasks(message.from_user.id)
-        if not tasks:
-            bot.reply_to(message, "У вас нет задач для экспорта.")
-            return
-        csv_data = "Номер;Статус;Текст;Дата создания\n"
-        for task in tasks:
-            status = "Выполнено" if task['done'] else "Не выполнено"
-            try:
-                created_dt = datetime.fromisoformat(task['created_at'])
-                formatted_date = created_dt.strftime('%Y-%m-%d %H:%M:%S')
-            except (ValueError, TypeError):
-                formatted_date = str(task['created_at'])
-            csv_data += f"{task['task_id_in_list']};{status};{task['text']};{formatted_date}\n"
-        bot.send_document(
-            message.chat.id,
-            document=csv_data.encode('utf-8'),
-            caption="Ваши задачи (CSV)"
-        )
+        # COPY пишет CSV во временный файл, без промежуточной копии в BytesIO.
+        # Память при отправке не ограничена: requests всё равно читает файл
+        # целиком в тело multipart-запроса
+        with tempfile.TemporaryFile(suffix=".csv", buffering=EXPORT_BUFFER_SIZE) as f:
+            if not export_tasks_csv(message.from_user.id, f):
+                bot.reply_to(message, "У вас нет задач для экспорта.")
+                return
+            f.seek(0)
+            bot.send_document(
+                message.chat.id,
+                document=f,
+                visible_file_name="tasks.csv",
+                caption="Ваши задачи (CSV)"
+            )
     except Exception as e:
-        logger.error(f"Ошибка при экспорте задач user_id={message.from_user.id}: {e}")
+        logger.error("Ошибка при экспорте задач user_id=%s: %s", message.from_user.id, e)
         bot.reply_to(message, "Произошла ошибка при экспорте. Попробуйте позже.")
 
 
+def check_saved_task(message, expected_id, task_text, task_id):
+    """Сверить результат записи с номером, уже отправленным пользователю"""
+    try:
+        if task_id is None:
+            bot.send_message(message.chat.id, f"Не удалось сохранить задачу «{task_text}». Попробуйте ещё раз.")
+        elif task_id != expected_id:
+            bot.send_message(message.chat.id, f"Поправка: задача «{task_text}» сохранена под №{task_id}.")
+    except Exception as e:
+        logger.error("Ошибка при отправке поправки user_id=%s: %s", message.from_user.id, e)
+
+
 @bot.message_handler(func=lambda message: True, content_types=['text'])
 def add_task(message):
     user_id = message.from_user.id
     text = message.text.strip()
 
+    with user_state_lock:
+        state = user_state.get(user_id)
+
     # Если идёт диалог — обрабатываем ответ
-    if user_id in user_state:
-        stage = user_state[user_id]['stage']
-        data = user_state[user_id]['data']
+    if state:
+        stage = state['stage']
+        data = state['data']
 
         if stage == 'waiting_surname':
             data['surname'] = text
-            user_state[user_id]['stage'] = 'waiting_task'
+            state['stage'] = 'waiting_task'
+            with user_state_lock:
+                user_state[user_id] = state  # продлеваем срок жизни диалога
             bot.reply_to(message, "Спасибо! Теперь напишите саму задачу.")
             return
 
         elif stage == 'waiting_task':
             data['task_text'] = text
 
-            # Сохраняем в БД
-            task_id = save_task_to_db(
-                user_id,
-                data['task_text']
-            )
-
-            if task_id:
-                bot.reply_to(
-                    message,
-                    f"[✳️] Задача №{task_id} добавлена!\n"
-                    f"Задача: {data['task_text']}"
-                )
+            # Сохраняем в БД. Если номер новой задачи известен по кэшу —
+            # отвечаем сразу, не дожидаясь записи, и поправляемся при расхождении.
+            # Ответ уходит до постановки в очередь, чтобы поправка не обогнала его
+            expected_id = predict_task_number(user_id)
+            if expected_id is not None:
+                try:
+                    bot.reply_to(message, TASK_ADDED_MESSAGE.format(task_id=expected_id, text=text))
+                finally:
+                    enqueue_task(user_id, text).add_done_callback(
+                        lambda f: followup_executor.submit(
+                            check_saved_task, message, expected_id, text, f.result()
+                        )
+                    )
             else:
-                bot.reply_to(message, "Не удалось добавить задачу. Попробуйте ещё раз.")
+                task_id = enqueue_task(user_id, text).result()
+                if task_id:
+                    bot.reply_to(message, TASK_ADDED_MESSAGE.format(task_id=task_id, text=text))
+                else:
+                    bot.reply_to(message, "Не удалось добавить задачу. Попробуйте ещё раз.")
 
             # Очищаем состояние
-            user_state.pop(user_id, None)
+            with user_state_lock:
+                user_state.pop(user_id, None)
             return
 
     # Если нет активного диалога — начинаем новый
     if text:  # проверяем, что сообщение не пустое
-        user_state[user_id] = {
-            'stage': 'waiting_surname',
-            'data': {'task_text': text}
-        }
+        with user_state_lock:
+            user_state[user_id] = {
+                'stage': 'waiting_surname',
+                'data': {'task_text': text}
+            }
         bot.reply_to(message, "Пожалуйста, укажите вашу фамилию:")
     else:
         bot.reply_to(message, "Текст задачи не может быть пустым!")
 
 
 
+class WebhookHandler(BaseHTTPRequestHandler):
+    """Приём обновлений от Telegram; обработчики выполняются в пуле потоков бота"""
+
+    def do_POST(self):
+        secret = self.headers.get('X-Telegram-Bot-Api-Secret-Token')
+        # URL без пути Telegram запрашивает как «/»
+        if (urlparse(self.path).path != WEBHOOK_PATH
+                or not hmac.compare_digest((secret or '').encode(), WEBHOOK_SECRET.encode())):
+            self.send_response(403)
+            self.end_headers()
+            return
+        try:
+            body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+            update = telebot.types.Update.de_json(body.decode('utf-8'))
+        except Exception as e:
+            logger.warning("Некорректное обновление от вебхука: %s", e)
+            self.send_response(400)
+            self.end_headers()
+            return
+        bot.process_new_updates([update])
+        self.send_response(200)
+        self.end_headers()
+
+    def log_message(self, format, *args):
+        logger.debug("Webhook: " + format, *args)
+
+
+def run_webhook():
+    """Зарегистрировать вебхук в Telegram и принимать обновления по HTTP"""
+    bot.remove_webhook()
+    bot.set_webhook(url=WEBHOOK_URL, secret_token=WEBHOOK_SECRET)
+    server = ThreadingHTTPServer(('0.0.0.0', WEBHOOK_PORT), WebhookHandler)
+    logger.info("Вебхук %s слушает порт %s", WEBHOOK_URL, WEBHOOK_PORT)
+    server.serve_forever()
+
+
 # Запуск бота
 if __name__ == '__main__':
     try:
         logger.info("Запуск бота...")
         # Инициализируем БД при старте
         init_db()
-        bot.polling(
-            none_stop=True,
-            interval=0,
-            timeout=30
-        )
+        if WEBHOOK_URL:
+            run_webhook()
+        else:
+            bot.remove_webhook()
+            # infinity_polling сам переподключается после ошибок сети/API
+            bot.infinity_polling(
+                timeout=20,
+                long_polling_timeout=30,
+                logger_level=logging.ERROR
+            )
     except Exception as e:
-        logger.error(f"Ошибка при запуске бота: {e}")
+        logger.error("Ошибка при запуске бота: %s", e)
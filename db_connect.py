@@ -1,306 +1,799 @@
 import os
+import atexit
 import logging
+import queue
+import select
+import threading
+import time
+from concurrent.futures import Future
+from contextlib import contextmanager
 import psycopg2
-from psycopg2.extras import RealDictCursor
+import psycopg2.extensions
+from psycopg2.pool import ThreadedConnectionPool
+from psycopg2.extras import execute_values
 import redis
-import json
+import msgpack
+from cachetools import TTLCache
 from dotenv import load_dotenv
 
 load_dotenv()
 
 logger = logging.getLogger(__name__)
 
+# Пул соединений PostgreSQL (создаётся при первом обращении). Верхняя граница
+# должна быть больше числа рабочих потоков бота плюс поток записи задач
+DB_POOL_MIN = int(os.getenv('DB_POOL_MIN', '2'))
+DB_POOL_MAX = int(os.getenv('DB_POOL_MAX', '20'))
+DB_PARAMS = {
+    'host': os.getenv('DB_HOST'),
+    'port': os.getenv('DB_PORT'),
+    'dbname': os.getenv('DB_NAME'),
+    'user': os.getenv('DB_USER'),
+    'password': os.getenv('DB_PASS')
+}
+_pool = None
+_pool_lock = threading.Lock()
+
+# Порядковый номер задачи в списке вычисляется при чтении: хранимый
+# task_id_in_list только растёт и после удаления не пересчитывается.
+NTH_TASK_ID_SQL = (
+    "SELECT id FROM tasks WHERE user_id = $1 "
+    "ORDER BY task_id_in_list OFFSET $2 LIMIT 1"
+)
+
+# Частые запросы подготавливаются (PREPARE) один раз на соединение пула,
+# дальше вызываются через EXECUTE без повторного разбора и планирования
+PREPARED_STATEMENTS = {
+    'load_tasks': ("bigint", (
+        "SELECT task_id_in_list, id, text, done, created_at "
+        "FROM tasks "
+        "WHERE user_id = $1 "
+        "ORDER BY task_id_in_list"
+    )),
+    'mark_done': ("bigint, bigint", (
+        f"UPDATE tasks SET done = TRUE WHERE id = ({NTH_TASK_ID_SQL}) "
+        "RETURNING task_id_in_list, id, text, done, created_at"
+    )),
+    'delete_task': ("bigint, bigint", (
+        f"DELETE FROM tasks WHERE id = ({NTH_TASK_ID_SQL}) "
+        "RETURNING task_id_in_list"
+    )),
+    'clear_all': ("bigint", "DELETE FROM tasks WHERE user_id = $1"),
+    'done_all': ("bigint", "UPDATE tasks SET done = TRUE WHERE user_id = $1 AND done = FALSE"),
+}
+
+class PreparedConnection(psycopg2.extensions.connection):
+    """Соединение пула, помнящее, подготовлены ли на нём запросы"""
+    prepared = False
+
+def prepare_statements(conn):
+    """Подготовить частые запросы на соединении"""
+    with conn.cursor() as cur:
+        for name, (arg_types, query) in PREPARED_STATEMENTS.items():
+            cur.execute(f"PREPARE {name} ({arg_types}) AS {query}")
+    conn.commit()
+    conn.prepared = True
+
+def get_pool():
+    """Получить пул соединений PostgreSQL, создав его при необходимости"""
+    global _pool
+    if _pool is None:
+        with _pool_lock:
+            if _pool is None:
+                _pool = ThreadedConnectionPool(
+                    minconn=DB_POOL_MIN,
+                    maxconn=DB_POOL_MAX,
+                    connection_factory=PreparedConnection,
+                    **DB_PARAMS
+                )
+                atexit.register(_pool.closeall)
+    return _pool
+
 # Подключение к PostgreSQL
-def get_db_conn():
+@contextmanager
+def db_conn(prepare=True, autocommit=False):
+    """Взять соединение из пула и вернуть его обратно (None, если БД недоступна)
+
+    prepare=False нужен только init_db: до создания таблиц подготовить запросы нельзя.
+    autocommit=True — для одиночных команд (чтений, NOTIFY): без BEGIN/COMMIT.
+    """
     try:
-        conn = psycopg2.connect(
-            host=os.getenv('DB_HOST'),
-            port=os.getenv('DB_PORT'),
-            dbname=os.getenv('DB_NAME'),
-            user=os.getenv('DB_USER'),
-            password=os.getenv('DB_PASS')
-        )
-        return conn
+        pool = get_pool()
+        conn = pool.getconn()
     except Exception as e:
-        logger.error(f"Ошибка подключения к PostgreSQL: {e}")
-        return None
+        logger.error("Ошибка подключения к PostgreSQL: %s", e)
+        yield None
+        return
 
-# Подключение к Redis
-redis_client = redis.Redis(
+    if prepare and not conn.prepared:
+        try:
+            prepare_statements(conn)
+        except Exception as e:
+            logger.error("Ошибка подготовки запросов PostgreSQL: %s", e)
+            pool.putconn(conn, close=True)
+            yield None
+            return
+
+    try:
+        if autocommit:
+            conn.autocommit = True
+        yield conn
+    finally:
+        close = bool(conn.closed)
+        if autocommit and not close:
+            try:
+                conn.autocommit = False  # в пул соединение возвращается в обычном режиме
+            except psycopg2.Error:
+                close = True
+        pool.putconn(conn, close=close)
+
+# Подключение к Redis: один пул на процесс (ответы разбирает hiredis, если установлен)
+REDIS_POOL_MAX = int(os.getenv('REDIS_POOL_MAX', '32'))
+redis_pool = redis.ConnectionPool(
     host=os.getenv('REDIS_HOST'),
     port=int(os.getenv('REDIS_PORT')),
     db=int(os.getenv('REDIS_DB')),
-    decode_responses=True,
+    max_connections=REDIS_POOL_MAX,
+    decode_responses=False,  # кэш хранит msgpack-байты, строки декодируем сами
     socket_connect_timeout=5,
     socket_timeout=5
 )
+redis_client = redis.Redis(connection_pool=redis_pool)
+
+# Задачи пользователя кэшируются в хэше Redis: поле — хранимый
+# task_id_in_list, значение — задача в msgpack. Поле-маркер отличает полностью
+# загруженный хэш от частичного, созданного точечным обновлением.
+# CACHE_VERSION входит в имя ключа и меняется вместе с форматом записей.
+CACHE_VERSION = 3
+CACHE_TTL = 3600
+CACHE_MARKER = b'_'
+# Готовый текст ответа на /list живёт недолго и сбрасывается при любом изменении
+LIST_TEXT_TTL = 60
+# При промахе кэша задачи из БД грузит один запрос, остальные ждут его
+LOAD_LOCK_TTL = 2
+LOAD_LOCK_WAIT = 0.05
 
 def cache_key(user_id):
-    return f"tasks:{user_id}"
+    return f"tasks:v{CACHE_VERSION}:{user_id}"
 
-def invalidate_cache(user_id):
-    """Очистить кэш для пользователя"""
+def list_text_key(user_id):
+    return f"tasks:fmt:{user_id}"
+
+# Каждое изменение увеличивает версию задач пользователя: список и текст,
+# прочитанные до изменения, в кэш уже не попадут (см. cache_tasks и cache_list_text)
+def tasks_version_key(user_id):
+    return f"tasks:ver:{user_id}"
+
+def load_lock_key(user_id):
+    return f"lock:tasks:{user_id}"
+
+# Записать текст списка, только если версия задач не изменилась с момента чтения
+_set_list_text = redis_client.register_script("""
+if (redis.call('GET', KEYS[2]) or '') == ARGV[2] then
+    redis.call('SET', KEYS[1], ARGV[1], 'EX', ARGV[3])
+end
+""")
+
+def get_list_text(user_id):
+    """Получить из кэша готовый текст списка задач и текущую версию задач
+
+    Текст равен None, если его нет; версию нужно передать в cache_list_text.
+    """
     try:
-        redis_client.delete(cache_key(user_id))
-        logger.debug(f"Кэш очищен для user_id={user_id}")
+        with redis_client.pipeline(transaction=False) as pipe:
+            pipe.get(list_text_key(user_id))
+            pipe.get(tasks_version_key(user_id))
+            text, version = pipe.execute()
     except Exception as e:
-        logger.error(f"Ошибка при очистке кэша для user_id={user_id}: {e}")
+        logger.error("Ошибка чтения текста списка из Redis для user_id=%s: %s", user_id, e)
+        return None, None
+    return (text.decode('utf-8') if text is not None else None), version or b''
 
-def init_db():
-    """Создать таблицу tasks, если её нет"""
-    conn = get_db_conn()
-    if not conn:
-        logger.error("Не удалось подключиться к БД для инициализации")
+def cache_list_text(user_id, text, version):
+    """Сохранить готовый текст списка задач, если с чтения version задачи не менялись"""
+    if version is None:
         return
-
     try:
-        with conn.cursor() as cur:
-            cur.execute("""
-                CREATE TABLE IF NOT EXISTS tasks (
-                    id SERIAL PRIMARY KEY,
-                    user_id BIGINT NOT NULL,
-                    text TEXT NOT NULL,
-                    done BOOLEAN DEFAULT FALSE,
-                    created_at TIMESTAMP DEFAULT NOW(),
-                    task_id_in_list INT NOT NULL
-                );
-            """)
-        conn.commit()
-        logger.info("Таблица tasks проверена/создана")
+        _set_list_text(
+            keys=[list_text_key(user_id), tasks_version_key(user_id)],
+            args=[text, version, LIST_TEXT_TTL]
+        )
     except Exception as e:
-        logger.error(f"Ошибка при создании таблицы tasks: {e}")
-    finally:
-        if conn:
-            conn.close()
+        logger.error("Ошибка записи текста списка в Redis для user_id=%s: %s", user_id, e)
+
+# Заменить хэш задач целиком, только если версия задач не изменилась с момента чтения
+_set_tasks = redis_client.register_script("""
+if (redis.call('GET', KEYS[2]) or '') ~= ARGV[1] then
+    return 0
+end
+redis.call('DEL', KEYS[1])
+for i = 3, #ARGV, 2 do
+    redis.call('HSET', KEYS[1], ARGV[i], ARGV[i + 1])
+end
+redis.call('EXPIRE', KEYS[1], ARGV[2])
+return 1
+""")
+
+def get_tasks_version(user_id):
+    """Текущая версия задач пользователя (её нужно прочитать до загрузки из БД)"""
+    return redis_client.get(tasks_version_key(user_id)) or b''
+
+def _mark_tasks_changed(pipe, user_id):
+    """Добавить в pipeline сброс текста списка и смену версии задач"""
+    pipe.delete(list_text_key(user_id))
+    pipe.incr(tasks_version_key(user_id))
+    pipe.expire(tasks_version_key(user_id), CACHE_TTL)
+
+def task_entry(row_id, text, done, created_at):
+    """Задача в том виде, в котором она хранится в кэше (дата для /list — готовой строкой)"""
+    return {
+        'id': row_id,
+        'text': text,
+        'done': done,
+        'created_at': created_at.isoformat(),
+        'created_str': created_at.strftime('%Y-%m-%d %H:%M')
+    }
+
+def number_tasks(tasks):
+    """Проставить задачам порядковые номера в списке"""
+    for number, task in enumerate(tasks, 1):
+        task['task_id_in_list'] = number
+    return tasks
 
+def cache_tasks(user_id, tasks_by_seq, version):
+    """Записать в кэш полный список задач пользователя, прочитанный при версии version
 
-def load_tasks_from_db(user_id):
-    """Загрузить задачи пользователя из PostgreSQL"""
-    conn = get_db_conn()
-    if not conn:
-        return []
+    Если задачи с тех пор изменились, запись пропускается: иначе старый снимок
+    затёр бы точечное обновление, сделанное после него.
+    """
+    args = [version, CACHE_TTL, CACHE_MARKER, b'']
+    for seq, task in tasks_by_seq.items():
+        args += (seq, msgpack.packb(task))
+    if not _set_tasks(keys=[cache_key(user_id), tasks_version_key(user_id)], args=args):
+        logger.debug("Задачи user_id=%s изменились во время загрузки, кэш не записан", user_id)
 
+def cache_put_tasks(tasks_by_user):
+    """Добавить или обновить задачи в кэше ({user_id: {seq: task}}) одним pipeline"""
     try:
-        with conn.cursor(cursor_factory=RealDictCursor) as cur:
-            cur.execute(
-                "SELECT id, text, done, created_at, task_id_in_list "
-                "FROM tasks "
-                "WHERE user_id = %s "
-                "ORDER BY task_id_in_list",
-                (user_id,)
-            )
-            tasks = []
-            for row in cur.fetchall():
-                task = dict(row)
-                task['created_at'] = task['created_at'].isoformat()
-                tasks.append(task)
-            redis_client.set(cache_key(user_id), json.dumps(tasks))
-            return tasks
+        with redis_client.pipeline() as pipe:
+            for user_id, tasks_by_seq in tasks_by_user.items():
+                key = cache_key(user_id)
+                pipe.hset(key, mapping={
+                    seq: msgpack.packb(task) for seq, task in tasks_by_seq.items()
+                })
+                pipe.expire(key, CACHE_TTL)
+                _mark_tasks_changed(pipe, user_id)
+            pipe.execute()
     except Exception as e:
-        logger.error(f"Ошибка загрузки задач из БД: {e}")
-        return []
-    finally:
-        if conn:
-            conn.close()
-
-def save_task_to_db(user_id, text):
-    """Добавить задачу в PostgreSQL"""
-    conn = get_db_conn()
-    if not conn:
-        return None
+        logger.error("Ошибка при обновлении кэша для user_id=%s: %s", list(tasks_by_user), e)
+        for user_id in tasks_by_user:
+            invalidate_cache(user_id)
+    for user_id in tasks_by_user:
+        invalidate_local_cache(user_id)
+
+def cache_put_task(user_id, seq, task):
+    """Добавить или обновить одну задачу в кэше"""
+    cache_put_tasks({user_id: {seq: task}})
+
+def cache_drop_task(user_id, seq):
+    """Удалить одну задачу из кэша"""
+    try:
+        with redis_client.pipeline() as pipe:
+            pipe.hdel(cache_key(user_id), seq)
+            _mark_tasks_changed(pipe, user_id)
+            pipe.execute()
+    except Exception as e:
+        logger.error("Ошибка при обновлении кэша для user_id=%s: %s", user_id, e)
+        invalidate_cache(user_id)
+    invalidate_local_cache(user_id)
 
+def invalidate_cache(user_id):
+    """Очистить кэш для пользователя"""
+    invalidate_local_cache(user_id)
     try:
-        with conn:
+        with redis_client.pipeline() as pipe:
+            pipe.delete(cache_key(user_id))
+            _mark_tasks_changed(pipe, user_id)
+            pipe.execute()
+        logger.debug("Кэш очищен для user_id=%s", user_id)
+    except Exception as e:
+        logger.error("Ошибка при очистке кэша для user_id=%s: %s", user_id, e)
+
+# Списки задач дополнительно держатся в памяти процесса. Процессы сообщают
+# друг другу об изменениях через NOTIFY tasks_changed (payload — user_id);
+# пока слушатель не подключён, локальный кэш не используется.
+NOTIFY_CHANNEL = 'tasks_changed'
+LOCAL_CACHE_TTL = 60
+_local_tasks = TTLCache(maxsize=10_000, ttl=LOCAL_CACHE_TTL)
+_local_tasks_lock = threading.Lock()
+_local_generation = 0  # растёт при каждой инвалидации
+_listener = None
+_listener_lock = threading.Lock()
+_listener_ready = threading.Event()
+
+def invalidate_local_cache(user_id=None):
+    """Забыть локальную копию задач пользователя (или всех, если user_id=None)"""
+    global _local_generation
+    with _local_tasks_lock:
+        _local_generation += 1
+        if user_id is None:
+            _local_tasks.clear()
+        else:
+            _local_tasks.pop(user_id, None)
+
+def notify_tasks_changed(user_ids):
+    """Сообщить всем процессам, что задачи пользователей изменились
+
+    Вызывается после коммита изменения И после обновления Redis: иначе другой
+    процесс, получив уведомление, мог бы перечитать из Redis ещё старые задачи
+    и держать их в памяти до LOCAL_CACHE_TTL. Поэтому NOTIFY идёт отдельной
+    командой в autocommit, а не внутри изменяющей транзакции.
+
+    Цена — ещё одно получение соединения из пула и запрос к PostgreSQL на каждое
+    изменение, даже если бот запущен в одном экземпляре.
+    """
+    try:
+        with db_conn(autocommit=True) as conn:
+            if not conn:
+                return
             with conn.cursor() as cur:
                 cur.execute(
-                    "SELECT MAX(task_id_in_list) FROM tasks WHERE user_id = %s",
-                    (user_id,)
+                    "SELECT pg_notify(%s, u::text) FROM unnest(%s::bigint[]) AS u",
+                    (NOTIFY_CHANNEL, list(user_ids))
                 )
-                max_id = cur.fetchone()[0]
-                new_id = (max_id or 0) + 1
+    except Exception as e:
+        logger.error("Ошибка отправки уведомления об изменении задач: %s", e)
+
+def _listen_loop():
+    """Фоновый поток: слушать NOTIFY и сбрасывать локальный кэш"""
+    while True:
+        conn = None
+        try:
+            conn = psycopg2.connect(**DB_PARAMS)
+            conn.autocommit = True
+            with conn.cursor() as cur:
+                cur.execute(f"LISTEN {NOTIFY_CHANNEL}")
+            # Пока слушателя не было, уведомления могли потеряться
+            invalidate_local_cache()
+            _listener_ready.set()
+            while True:
+                if select.select([conn], [], [], 60) == ([], [], []):
+                    continue
+                conn.poll()
+                while conn.notifies:
+                    invalidate_local_cache(int(conn.notifies.pop(0).payload))
+        except Exception as e:
+            _listener_ready.clear()
+            invalidate_local_cache()
+            logger.error("Ошибка слушателя уведомлений PostgreSQL: %s", e)
+            time.sleep(5)
+        finally:
+            if conn:
+                conn.close()
+
+def start_listener():
+    """Запустить фоновый поток LISTEN, если он ещё не запущен"""
+    global _listener
+    if _listener is None:
+        with _listener_lock:
+            if _listener is None:
+                _listener = threading.Thread(target=_listen_loop, name="tasks-listener", daemon=True)
+                _listener.start()
+
+# Всё, что создаёт init_db
+SCHEMA_RELATIONS = ('tasks', 'user_task_counters', 'idx_tasks_user_tidx', 'idx_tasks_user_created')
+
+def init_db():
+    """Создать таблицы tasks, user_task_counters и индексы, если их нет"""
+    with db_conn(prepare=False) as conn:
+        if not conn:
+            logger.error("Не удалось подключиться к БД для инициализации")
+            return
 
+        try:
+            with conn.cursor() as cur:
+                # Обычный перезапуск: всё уже создано, DDL (и его блокировки) не нужен
                 cur.execute(
-                    "INSERT INTO tasks (user_id, text, task_id_in_list) "
-                    "VALUES (%s, %s, %s) "
-                    "RETURNING task_id_in_list",
-                    (user_id, text, new_id)
+                    "SELECT bool_and(to_regclass(r) IS NOT NULL) FROM unnest(%s::text[]) AS r",
+                    (list(SCHEMA_RELATIONS),)
                 )
-                task_id = cur.fetchone()[0]
-                conn.commit()
-                invalidate_cache(user_id)
-                return task_id
-    except Exception as e:
-        logger.error(f"Ошибка сохранения задачи в БД: {e}")
-        return None
-    finally:
-        if conn:
-            conn.close()
+                if cur.fetchone()[0]:
+                    conn.commit()
+                    logger.info("Таблицы tasks, user_task_counters и индексы уже существуют")
+                    return
+
+                # Всё ниже выполняется в одной транзакции
+                cur.execute("""
+                    CREATE TABLE IF NOT EXISTS tasks (
+                        id SERIAL PRIMARY KEY,
+                        user_id BIGINT NOT NULL,
+                        text TEXT NOT NULL,
+                        done BOOLEAN DEFAULT FALSE,
+                        created_at TIMESTAMP DEFAULT NOW(),
+                        task_id_in_list INT NOT NULL
+                    );
+                """)
+                # Индексы для выборок по пользователю и сортировки
+                cur.execute(
+                    "CREATE INDEX IF NOT EXISTS idx_tasks_user_tidx "
+                    "ON tasks (user_id, task_id_in_list);"
+                )
+                cur.execute(
+                    "CREATE INDEX IF NOT EXISTS idx_tasks_user_created "
+                    "ON tasks (user_id, created_at);"
+                )
+                # Счётчик последнего выданного task_id_in_list для каждого пользователя
+                cur.execute("""
+                    CREATE TABLE IF NOT EXISTS user_task_counters (
+                        user_id BIGINT PRIMARY KEY,
+                        next_id INT NOT NULL
+                    );
+                """)
+                cur.execute("""
+                    INSERT INTO user_task_counters (user_id, next_id)
+                    SELECT user_id, MAX(task_id_in_list) FROM tasks GROUP BY user_id
+                    ON CONFLICT (user_id) DO NOTHING;
+                """)
+            conn.commit()
+            logger.info("Таблицы tasks, user_task_counters и индексы проверены/созданы")
+        except Exception as e:
+            logger.error("Ошибка при создании таблицы tasks: %s", e)
 
-def mark_done_in_db(user_id, task_id_in_list):
-    """Отметить задачу как выполненную"""
-    conn = get_db_conn()
-    if not conn:
-        logger.error("Не удалось установить соединение с БД")
-        return False
 
+def load_tasks_from_db(user_id):
+    """Загрузить задачи пользователя из PostgreSQL (None при ошибке)"""
     try:
-        with conn:
+        with db_conn(autocommit=True) as conn:
+            if not conn:
+                return None
+
+            # Версию читаем до запроса: изменение после неё отменит запись кэша
+            version = get_tasks_version(user_id)
             with conn.cursor() as cur:
-                cur.execute(
-                    "UPDATE tasks SET done = TRUE WHERE user_id = %s AND task_id_in_list = %s",
-                    (user_id, task_id_in_list)
-                )
-                if cur.rowcount == 0:
-                    logger.warning(f"Задача не найдена: user_id={user_id}, task_id_in_list={task_id_in_list}")
-                    return False
-                conn.commit()
-                invalidate_cache(user_id)
-                logger.info(f"Задача отмечена как выполненная: user_id={user_id}, task_id_in_list={task_id_in_list}")
-                return True
+                cur.execute("EXECUTE load_tasks (%s)", (user_id,))
+                rows = cur.fetchall()
+
+        # Соединение уже в пуле — разбираем строки и пишем кэш без него
+        tasks_by_seq = {
+            seq: task_entry(row_id, text, done, created_at)
+            for seq, row_id, text, done, created_at in rows
+        }
+        cache_tasks(user_id, tasks_by_seq, version)
+        return number_tasks(list(tasks_by_seq.values()))
     except Exception as e:
-        logger.error(f"Ошибка при отметке задачи как выполненной (user_id={user_id}, task_id_in_list={task_id_in_list}): {e}")
-        return False
-    finally:
-        if conn:
-            conn.close()
+        logger.error("Ошибка загрузки задач из БД: %s", e)
+        return None
 
-def delete_task_from_db(user_id, task_id_in_list):
-    """Удалить задачу и пересчитать task_id_in_list"""
-    conn = get_db_conn()
-    if not conn:
-        logger.error("Не удалось установить соединение с БД")
-        return False
+EXPORT_CSV_HEADER = "Номер;Статус;Текст;Дата создания\n".encode('utf-8')
+
+def export_tasks_csv(user_id, out):
+    """Записать задачи пользователя в CSV через COPY (без кэша); вернуть False, если задач нет"""
+    with db_conn(autocommit=True) as conn:
+        if not conn:
+            raise ConnectionError("Нет соединения с PostgreSQL")
+
+        out.write(EXPORT_CSV_HEADER)
+        start = out.tell()
+        with conn.cursor() as cur:
+            # user_id — целое число из Telegram, подставляем его напрямую
+            cur.copy_expert(
+                "COPY ("
+                "SELECT ROW_NUMBER() OVER (ORDER BY task_id_in_list), "
+                "CASE WHEN done THEN 'Выполнено' ELSE 'Не выполнено' END, "
+                "text, "
+                "to_char(created_at, 'YYYY-MM-DD HH24:MI:SS') "
+                f"FROM tasks WHERE user_id = {int(user_id)} "
+                "ORDER BY task_id_in_list"
+                ") TO STDOUT WITH (FORMAT csv, DELIMITER ';')",
+                out
+            )
+        return out.tell() > start
+
+# Новые задачи пишет в БД один фоновый поток: всё, что накопилось в очереди,
+# пока шла предыдущая запись (до BATCH_MAX_SIZE штук), уходит одним INSERT
+BATCH_MAX_SIZE = 500
+_add_queue = queue.Queue()
+_writer = None
+_writer_lock = threading.Lock()
+
+INSERT_BATCH_SQL = """
+    WITH new_tasks (user_id, text, pos) AS (VALUES %s),
+    numbered AS (
+        SELECT user_id, text,
+               ROW_NUMBER() OVER (PARTITION BY user_id ORDER BY pos) AS rn,
+               COUNT(*) OVER (PARTITION BY user_id) AS cnt
+        FROM new_tasks
+    ),
+    counters AS (
+        INSERT INTO user_task_counters (user_id, next_id)
+        SELECT user_id, COUNT(*) FROM new_tasks GROUP BY user_id
+        ON CONFLICT (user_id) DO UPDATE
+            SET next_id = user_task_counters.next_id + EXCLUDED.next_id
+        RETURNING user_id, next_id
+    )
+    INSERT INTO tasks (user_id, text, task_id_in_list)
+    SELECT n.user_id, n.text, c.next_id - n.cnt + n.rn
+    FROM numbered n
+    JOIN counters c ON c.user_id = n.user_id
+    RETURNING user_id, task_id_in_list, id, text, created_at
+"""
+
+def insert_tasks_batch(batch):
+    """Записать пачку (user_id, text) одним запросом; вернуть номера задач в списках"""
+    with db_conn() as conn:
+        if not conn:
+            return [None] * len(batch)
 
-    try:
         with conn:
             with conn.cursor() as cur:
-                # Удаляем задачу
-                cur.execute(
-                    "DELETE FROM tasks WHERE user_id = %s AND task_id_in_list = %s",
-                    (user_id, task_id_in_list)
+                inserted = execute_values(
+                    cur, INSERT_BATCH_SQL,
+                    [(user_id, text, pos) for pos, (user_id, text) in enumerate(batch)],
+                    template="(%s::bigint, %s::text, %s)",
+                    page_size=BATCH_MAX_SIZE,
+                    fetch=True
                 )
-                if cur.rowcount == 0:
-                    logger.warning(f"Задача не найдена при удалении: user_id={user_id}, task_id_in_list={task_id_in_list}")
-                    return False
-
-                # Пересчитываем task_id_in_list для оставшихся задач
+                user_ids = list({user_id for user_id, _ in batch})
                 cur.execute(
-                    """
-                    UPDATE tasks
-                    SET task_id_in_list = subquery.new_id
-                    FROM (
-                        SELECT id, ROW_NUMBER() OVER (ORDER BY created_at) AS new_id
-                        FROM tasks
-                        WHERE user_id = %s
-                    ) AS subquery
-                    WHERE tasks.id = subquery.id
-                    """,
-                    (user_id,)
+                    "SELECT user_id, COUNT(*) FROM tasks WHERE user_id = ANY(%s) GROUP BY user_id",
+                    (user_ids,)
                 )
+                counts = dict(cur.fetchall())
                 conn.commit()
-                invalidate_cache(user_id)
-                logger.info(f"Задача удалена: user_id={user_id}, task_id_in_list={task_id_in_list}")
-                return True
+
+    # Новые задачи пользователя — последние в его списке, в порядке очереди
+    inserted_by_user = {}
+    for row in sorted(inserted, key=lambda r: r[1]):
+        inserted_by_user.setdefault(row[0], []).append(row)
+    positions_by_user = {}
+    for pos, (user_id, _) in enumerate(batch):
+        positions_by_user.setdefault(user_id, []).append(pos)
+
+    results = [None] * len(batch)
+    new_tasks = {}
+    for user_id, positions in positions_by_user.items():
+        rows = inserted_by_user.get(user_id, [])
+        first_number = counts.get(user_id, 0) - len(rows) + 1
+        for number, pos, row in zip(range(first_number, first_number + len(rows)), positions, rows):
+            _, seq, row_id, text, created_at = row
+            results[pos] = number
+            new_tasks.setdefault(user_id, {})[seq] = task_entry(row_id, text, False, created_at)
+    # Кэш всех пользователей пачки обновляется за один запрос к Redis
+    cache_put_tasks(new_tasks)
+    notify_tasks_changed(user_ids)
+    return results
+
+def _writer_loop():
+    """Фоновый поток: забирать задачи из очереди и сохранять их пачками"""
+    while True:
+        batch = [_add_queue.get()]
+        while len(batch) < BATCH_MAX_SIZE:
+            try:
+                batch.append(_add_queue.get_nowait())
+            except queue.Empty:
+                break
+
+        try:
+            results = insert_tasks_batch([(user_id, text) for user_id, text, _ in batch])
+        except Exception as e:
+            logger.error("Ошибка сохранения задач в БД (в пачке %s): %s", len(batch), e)
+            results = [None] * len(batch)
+        for (_, _, future), result in zip(batch, results):
+            future.set_result(result)
+
+def start_writer():
+    """Запустить фоновый поток записи задач, если он ещё не запущен"""
+    global _writer
+    if _writer is None:
+        with _writer_lock:
+            if _writer is None:
+                _writer = threading.Thread(target=_writer_loop, name="task-writer", daemon=True)
+                _writer.start()
+
+def enqueue_task(user_id, text):
+    """Поставить задачу в очередь записи; Future вернёт её номер в списке (None при ошибке)"""
+    start_writer()
+    future = Future()
+    _add_queue.put((user_id, text, future))
+    return future
+
+def predict_task_number(user_id):
+    """Номер, который получит новая задача, по данным кэша (None, если кэша нет)"""
+    if _listener_ready.is_set():
+        with _local_tasks_lock:
+            tasks = _local_tasks.get(user_id)
+        if tasks is not None:
+            return len(tasks) + 1
+
+    key = cache_key(user_id)
+    try:
+        with redis_client.pipeline(transaction=False) as pipe:
+            pipe.hexists(key, CACHE_MARKER)
+            pipe.hlen(key)
+            complete, size = pipe.execute()
     except Exception as e:
-        logger.error(f"Ошибка при удалении задачи (user_id={user_id}, task_id_in_list={task_id_in_list}): {e}")
+        logger.error("Ошибка чтения кэша для user_id=%s: %s", user_id, e)
+        return None
+    # В size уже учтено поле-маркер, оно и даёт «+1»
+    return size if complete else None
+
+def mark_done_in_db(user_id, task_id_in_list):
+    """Отметить задачу как выполненную"""
+    if task_id_in_list < 1:
         return False
-    finally:
-        if conn:
-            conn.close()
-def clear_all_tasks_db(user_id):
-    """Удалить все задачи пользователя и вернуть количество удалённых"""
-    conn = get_db_conn()
-    if not conn:
-        logger.error("Не удалось установить соединение с БД")
-        return False, 0
 
+    with db_conn() as conn:
+        if not conn:
+            logger.error("Не удалось установить соединение с БД")
+            return False
 
-    try:
-        with conn:
-            with conn.cursor() as cur:
-                # Считаем количество задач перед удалением
-                cur.execute(
-                    "SELECT COUNT(*) FROM tasks WHERE user_id = %s",
-                    (user_id,)
-                )
-                count_before = cur.fetchone()[0]
+        try:
+            with conn:
+                with conn.cursor() as cur:
+                    cur.execute(
+                        "EXECUTE mark_done (%s, %s)",
+                        (user_id, task_id_in_list - 1)
+                    )
+                    row = cur.fetchone()
+                    conn.commit()
+        except Exception as e:
+            logger.error("Ошибка при отметке задачи как выполненной (user_id=%s, task_id_in_list=%s): %s", user_id, task_id_in_list, e)
+            return False
+
+    if row is None:
+        logger.warning("Задача не найдена: user_id=%s, task_id_in_list=%s", user_id, task_id_in_list)
+        return False
 
-                if count_before == 0:
-                    return True, 0  # Нет задач — успешно, но удалено 0
+    seq, row_id, text, done, created_at = row
+    cache_put_task(user_id, seq, task_entry(row_id, text, done, created_at))
+    notify_tasks_changed([user_id])
+    logger.info("Задача отмечена как выполненная: user_id=%s, task_id_in_list=%s", user_id, task_id_in_list)
+    return True
 
+def delete_task_from_db(user_id, task_id_in_list):
+    """Удалить задачу по её номеру в списке"""
+    if task_id_in_list < 1:
+        return False
 
-                # Удаляем все задачи
-                cur.execute(
-                    "DELETE FROM tasks WHERE user_id = %s",
-                    (user_id,)
-                )
-                conn.commit()
-                invalidate_cache(user_id)
+    with db_conn() as conn:
+        if not conn:
+            logger.error("Не удалось установить соединение с БД")
+            return False
 
-                logger.info(f"Удалены все задачи для user_id={user_id} (количество: {count_before})")
-                return True, count_before
-    except Exception as e:
-        logger.error(f"Ошибка при удалении всех задач для user_id={user_id}: {e}")
-        return False, 0
-    finally:
-        if conn:
-            conn.close()
+        try:
+            with conn:
+                with conn.cursor() as cur:
+                    # Удаляем задачу; номера остальных сдвинутся сами при чтении
+                    cur.execute(
+                        "EXECUTE delete_task (%s, %s)",
+                        (user_id, task_id_in_list - 1)
+                    )
+                    row = cur.fetchone()
+                    conn.commit()
+        except Exception as e:
+            logger.error("Ошибка при удалении задачи (user_id=%s, task_id_in_list=%s): %s", user_id, task_id_in_list, e)
+            return False
+
+    if row is None:
+        logger.warning("Задача не найдена при удалении: user_id=%s, task_id_in_list=%s", user_id, task_id_in_list)
+        return False
 
+    cache_drop_task(user_id, row[0])
+    notify_tasks_changed([user_id])
+    logger.info("Задача удалена: user_id=%s, task_id_in_list=%s", user_id, task_id_in_list)
+    return True
 
+def clear_all_tasks_db(user_id):
+    """Удалить все задачи пользователя и вернуть количество удалённых"""
+    with db_conn() as conn:
+        if not conn:
+            logger.error("Не удалось установить соединение с БД")
+            return False, 0
 
-def done_all_tasks_db(user_id):
-    """Отметить все задачи пользователя как выполненные"""
-    conn = get_db_conn()
-    if not conn:
-        logger.error("Не удалось установить соединение с БД")
-        return False, 0
+        try:
+            with conn:
+                with conn.cursor() as cur:
+                    # Удаляем все задачи; количество берём из rowcount
+                    cur.execute("EXECUTE clear_all (%s)", (user_id,))
+                    deleted_count = cur.rowcount
+                    conn.commit()
+        except Exception as e:
+            logger.error("Ошибка при удалении всех задач для user_id=%s: %s", user_id, e)
+            return False, 0
 
-    try:
-        with conn:
-            with conn.cursor() as cur:
-                # Считаем количество невыполненных задач
-                cur.execute(
-                    "SELECT COUNT(*) FROM tasks WHERE user_id = %s AND done = FALSE",
-                    (user_id,)
-                )
-                count_pending = cur.fetchone()[0]
+    if deleted_count == 0:
+        return True, 0  # Нет задач — успешно, но удалено 0
 
-                if count_pending == 0:
-                    return True, 0  # Все уже выполнены — успешно, но обновлено 0
+    invalidate_cache(user_id)
+    notify_tasks_changed([user_id])
+    logger.info("Удалены все задачи для user_id=%s (количество: %s)", user_id, deleted_count)
+    return True, deleted_count
 
-                # Отмечаем все задачи как выполненные
-                cur.execute(
-                    "UPDATE tasks SET done = TRUE WHERE user_id = %s",
-                    (user_id,)
-                )
-                conn.commit()
-                invalidate_cache(user_id)
 
-                logger.info(f"Все задачи отмечены как выполненные для user_id={user_id} (обновлено: {count_pending})")
-                return True, count_pending
-    except Exception as e:
-        logger.error(f"Ошибка при отметке всех задач как выполненных для user_id={user_id}: {e}")
-        return False, 0
-    finally:
-        if conn:
-            conn.close()
+def done_all_tasks_db(user_id):
+    """Отметить все задачи пользователя как выполненные"""
+    with db_conn() as conn:
+        if not conn:
+            logger.error("Не удалось установить соединение с БД")
+            return False, 0
 
+        try:
+            with conn:
+                with conn.cursor() as cur:
+                    # Отмечаем только невыполненные задачи; их количество — rowcount
+                    cur.execute("EXECUTE done_all (%s)", (user_id,))
+                    updated_count = cur.rowcount
+                    conn.commit()
+        except Exception as e:
+            logger.error("Ошибка при отметке всех задач как выполненных для user_id=%s: %s", user_id, e)
+            return False, 0
+
+    if updated_count == 0:
+        return True, 0  # Все уже выполнены — успешно, но обновлено 0
+
+    invalidate_cache(user_id)
+    notify_tasks_changed([user_id])
+    logger.info("Все задачи отмечены как выполненные для user_id=%s (обновлено: %s)", user_id, updated_count)
+    return True, updated_count
+
+
+def read_cached_tasks(user_id):
+    """Прочитать задачи пользователя из кэша Redis (None, если кэша нет)"""
+    # Хэш без маркера — неполный
+    cached = redis_client.hgetall(cache_key(user_id))
+    if CACHE_MARKER not in cached:
+        return None
+    try:
+        tasks = [
+            msgpack.unpackb(cached[seq])
+            for seq in sorted((f for f in cached if f != CACHE_MARKER), key=int)
+        ]
+    except ValueError as e:
+        logger.error("Ошибка декодирования msgpack из Redis для user_id=%s: %s", user_id, e)
+        return None
+    logger.debug("Задачи для user_id=%s загружены из Redis", user_id)
+    return number_tasks(tasks)
 
 
 def get_user_tasks(user_id):
-    """Получить задачи пользователя (из кэша Redis или из PostgreSQL)"""
-    # 1. Проверяем кэш Redis
-    cached = redis_client.get(cache_key(user_id))
-    if cached:
-        try:
-            tasks = json.loads(cached)
-            logger.debug(f"Задачи для user_id={user_id} загружены из Redis")
+    """Получить задачи пользователя (из памяти процесса, кэша Redis или PostgreSQL)
+
+    Возвращает None, если PostgreSQL недоступен.
+    """
+    start_listener()
+    use_local = _listener_ready.is_set()
+
+    # 0. Локальная копия в процессе
+    if use_local:
+        with _local_tasks_lock:
+            tasks = _local_tasks.get(user_id)
+            generation = _local_generation
+        if tasks is not None:
             return tasks
-        except json.JSONDecodeError as e:
-            logger.error(f"Ошибка декодирования JSON из Redis для user_id={user_id}: {e}")
-
 
-    # 2. Если кэша нет или он невалидный — загружаем из БД
-    tasks = load_tasks_from_db(user_id)
-    logger.debug(f"Задачи для user_id={user_id} загружены из PostgreSQL")
+    # 1. Проверяем кэш Redis
+    tasks = read_cached_tasks(user_id)
+    if tasks is None:
+        # 2. Кэша нет — в БД идёт только взявший блокировку; остальные один раз
+        # ждут, пока он заполнит кэш, и лишь потом читают БД сами
+        got_lock = redis_client.set(load_lock_key(user_id), "1", nx=True, ex=LOAD_LOCK_TTL)
+        if not got_lock:
+            time.sleep(LOAD_LOCK_WAIT)
+            tasks = read_cached_tasks(user_id)
+
+        if tasks is None:
+            try:
+                tasks = load_tasks_from_db(user_id)
+            finally:
+                if got_lock:
+                    redis_client.delete(load_lock_key(user_id))
+            if tasks is None:
+                return None  # ошибку БД не запоминаем
+            logger.debug("Задачи для user_id=%s загружены из PostgreSQL", user_id)
+
+    # Запоминаем, только если за время чтения ничего не инвалидировалось
+    if use_local:
+        with _local_tasks_lock:
+            if generation == _local_generation:
+                _local_tasks[user_id] = tasks
     return tasks